@@ -3,6 +3,7 @@ agent/prompt_map.py
 
 Simple mapping of system prompts by active_tab and BASE_PROMPT.
 """
+from functools import lru_cache
 from typing import Optional, Dict, Any
 import json
 
@@ -10,7 +11,7 @@ import json
 BASE_PROMPT = (
     "You are the RAGChecker Analyzer agent inside the RAGScope app (https://github.com/Arthur-g-p/RAGScope/tree/master). You are a read-only analysis agent for a RAG evaluation run. "
     "You have exactly one tool: dataset_query. Use it to read data; do not invent data. "
-    "The tool evaluates a pure Python expression over the current run with variables: data (full run) and questions (data['results']). "
+    "The tool evaluates a pure Python expression over the current run with variables: data (full run), questions (data['results']) and columns (per-question value tuples). "
     "Allowed builtins: len,sum,min,max,sorted,any,all,set,list,dict,tuple,enumerate,range,type,isinstance,str,int,float. "
     "No imports, no I/O, no mutation. Keep queries small using slicing and selecting only needed fields. "
     "You may issue multiple tool calls in one turn (up to 5)."
@@ -118,31 +119,48 @@ DATA_INTRO = (
     "  • retrieved2response: per-claim list of per-chunk labels for response claims (rows=claims, columns=chunks; shape [num_response_claims][num_chunks]).\n" 
     "  • metrics: per-question metrics (precision, recall, f1, etc.).\n"
     "- data['metrics']: aggregated run metrics (overall_metrics, retriever_metrics, generator_metrics).\n"
+    "- columns: dict of tuples aligned with questions (index i = questions[i]): 'query_ids', 'num_chunks', 'num_response_claims', 'num_gt_claims', plus one tuple per per-question metric name (e.g. 'f1', 'precision', 'recall'; None where missing).\n"
+    "  Prefer columns for aggregates, e.g. max((v for v in columns['f1'] if v is not None), default=None) or [columns['query_ids'][i] for i, v in enumerate(columns['f1']) if v is not None and v < 0.5].\n"
     "- Semantics: 'Entailment'=supports/used; 'Neutral'=neither; 'Contradiction'=conflicts.\n"
-    "- Tool (dataset_query): ONE pure Python expression over data/questions; no assignments/semicolons/newlines.\n"
+    "- Tool (dataset_query): ONE pure Python expression over data/questions/columns; no assignments/semicolons/newlines.\n"
     "  Allowed builtins: len,sum,min,max,sorted,any,all,set,list,dict,tuple,enumerate,range,type,isinstance,str,int,float.\n"
+    "  Allowed methods: get,keys,values,items,count,index,lower,upper,strip,split,startswith,endswith,join,replace,find. lambda only as key= of sorted/min/max; no dunder names/attributes; no ** or <<; repeat counts, range bounds and format widths up to 10000.\n"
     "  Use 'limit' to cap rows and 'char_limit' to cap string length. Keep outputs small.\n"
 )
 
 
-def build_prompt_for_tab(active_tab: Optional[str], view_context: Optional[Dict[str, Any]]) -> str:
-    parts = [BASE_PROMPT, METHODOLGY, FORMULAS_AND_CALCULATIONS, IMPROVMENT_STRATEGIES]
-    if active_tab and active_tab in TAB_PROMPTS:
-        parts.append(TAB_PROMPTS[active_tab])
-    elif active_tab:
-        parts.append(f"User tab: {active_tab}.")
+# Static prompt fragments are assembled once at import; only view_context varies per request.
+_STATIC_PREFIX = "\n".join((BASE_PROMPT, METHODOLGY, FORMULAS_AND_CALCULATIONS, IMPROVMENT_STRATEGIES))
+_TAB_PREFIX = {tab: _STATIC_PREFIX + "\n" + prompt for tab, prompt in TAB_PROMPTS.items()}
+_DATA_INTRO_SUFFIX = "\n" + DATA_INTRO
+
+
+def _prefix_for_tab(active_tab: str) -> str:
+    if active_tab in _TAB_PREFIX:
+        return _TAB_PREFIX[active_tab]
+    if active_tab:
+        return _STATIC_PREFIX + f"\nUser tab: {active_tab}."
+    return _STATIC_PREFIX
+
 
+@lru_cache(maxsize=256)
+def _assemble(active_tab: str, vc_json: str) -> str:
+    # Cached on (tab, canonical view_context JSON): repeated messages from the same view reuse the prompt.
+    view_part = "\nView context: " + vc_json if vc_json else ""
+    return "".join((_prefix_for_tab(active_tab), view_part, _DATA_INTRO_SUFFIX))
+
+
+def build_prompt_for_tab(active_tab: Optional[str], view_context: Optional[Dict[str, Any]]) -> str:
     # Always append view_context as-is 
+    vc_json = ""
     if isinstance(view_context, dict) and view_context:
         try:
-            vc_json = json.dumps(view_context, ensure_ascii=False, separators=(",", ":"))
-            parts.append("View context: " + vc_json)
+            # sort_keys gives a stable cache key regardless of client key order
+            vc_json = json.dumps(view_context, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
         except Exception:
             # Fallback to keys only if serialization fails
             keys = ", ".join(sorted(view_context.keys()))
-            parts.append("View context keys: " + keys)
+            return "".join((_prefix_for_tab(active_tab or ""), "\nView context keys: " + keys, _DATA_INTRO_SUFFIX))
 
     # Always append data intro
-    parts.append(DATA_INTRO)
-    return "\n".join(parts)
-
+    return _assemble(active_tab or "", vc_json)
@@ -1,16 +1,33 @@
 # Agent module for LLM streaming chat + dataset_query tool (single endpoint)
 # Single-user, no persistence. Keeps current run in memory when provided with each call.
 
+import ast
 import asyncio
 import json
 import logging
+import math
 import os
+import re
 import uuid
-from typing import Any, Dict, Iterable, Optional, List
+import weakref
+from collections import deque
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import islice
+from typing import Any, AsyncIterator, Callable, Dict, Optional, List, Tuple
 import httpx
+import orjson
+
+try:
+    import resource  # POSIX only; used for worker CPU/memory limits
+except ImportError:
+    resource = None
 
 from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from litellm import acompletion
 
@@ -71,9 +88,10 @@ TOOLS = [
             "name": "dataset_query",
             "description": (
                 "Evaluate ONE pure Python expression over the current run (read-only).\n"
-                "Variables: data (enhanced run), questions (data['results'] list).\n"
+                "Variables: data (enhanced run), questions (data['results'] list), columns (per-question value tuples aligned with questions).\n"
                 "Allowed builtins: len,sum,min,max,sorted,any,all,set,list,dict,tuple,enumerate,range,type,isinstance,str,int,float.\n"
-                "Rules: SINGLE expression only; no assignments, no semicolons, no newlines. Use dict/list literals and comprehensions.\n"
+                "Allowed methods: get,keys,values,items,count,index,lower,upper,strip,split,startswith,endswith,join,replace,find; lambda only as key= of sorted/min/max.\n"
+                "Rules: SINGLE expression only; no assignments, no semicolons, no newlines, no ** or <<; repeat counts, range bounds and format widths up to 10000. Use dict/list literals and comprehensions.\n"
                 "Examples: [q['query_id'] for q in questions][:5] | {'n': len(questions)} | [ {'query_id': q.get('query_id')} for q in questions ]\n"
                 "Keep results small; use 'limit' and 'char_limit'."
             ),
@@ -92,7 +110,8 @@ TOOLS = [
 ]
 
 
-ALLOWED_BUILTINS = {
+# Read-only: shared by every evaluation
+ALLOWED_BUILTINS = MappingProxyType({
     "len": len,
     "sum": sum,
     "min": min,
@@ -111,16 +130,318 @@ ALLOWED_BUILTINS = {
     "str": str,
     "int": int,
     "float": float,
-}
-
-async def _eval_expr(expr: str, ctx: Dict[str, Any], timeout_ms: int = 400) -> Any:
-    loop = asyncio.get_event_loop()
-
-    def runner():
-        code = compile(expr, "<expr>", "eval")
-        return eval(code, {"__builtins__": ALLOWED_BUILTINS}, ctx)
+})
+
+# AST whitelist applied before compiling. Expressions may only call allowed builtins and a few
+# read-only methods; lambdas are accepted only as key= (sorted/min/max). Dunder names and
+# attributes are rejected, which closes the usual object-graph escapes.
+_ALLOWED_METHODS = frozenset({
+    "get", "keys", "values", "items", "count", "index",
+    "lower", "upper", "strip", "split", "startswith", "endswith", "join", "replace", "find",
+})
+_MAX_COMPREHENSION_GENERATORS = 3
+_MAX_EXPR_NODES = 2000
+# Size guard. One C-level call like [0]*10**9 or '%1000000000s' % '' allocates before the timeout can
+# fire, so sizes an expression spells out itself (repeat counts, range bounds, format widths; literals,
+# literal arithmetic and int('...') are folded) are capped here. This is best-effort: sizes computed
+# from run data are bounded only by the timeout and, on POSIX, the worker memory limit.
+_MAX_LITERAL_SIZE = 10_000
+# Folded magnitudes are clamped here, so literal arithmetic cannot build huge ints while validating
+_FOLD_CAP = 1 << 63
+_FORMAT_SPEC = re.compile(r"%(?:\([^)]*\))?[#0\- +]*(\*|\d+)?(?:\.(\*|\d+))?")
+_DIGITS = re.compile(r"\d+")
+# Calls whose result is a str or list, i.e. something '*' would repeat
+_SEQUENCE_CALLS = frozenset({"str", "list", "tuple", "sorted", "join", "replace", "strip", "lower", "upper", "split"})
+
+def _literal_size(node: ast.AST) -> Optional[int]:
+    """Upper bound on the magnitude of an integer spelled out in the expression, or None if unknown."""
+    if isinstance(node, ast.Constant):
+        return min(abs(node.value), _FOLD_CAP) if type(node.value) is int else None
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+        return _literal_size(node.operand)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod)):
+        left, right = _literal_size(node.left), _literal_size(node.right)
+        if left is None or right is None:
+            return None
+        if isinstance(node.op, ast.Mult):
+            return min(left * right, _FOLD_CAP)
+        if isinstance(node.op, (ast.Add, ast.Sub)):
+            return min(left + right, _FOLD_CAP)
+        return min(left, right) if isinstance(node.op, ast.Mod) else left
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "int"
+            and len(node.args) == 1 and not node.keywords and isinstance(node.args[0], ast.Constant)):
+        try:
+            return min(abs(int(node.args[0].value)), _FOLD_CAP)
+        except (TypeError, ValueError, OverflowError):
+            return None
+    return None
 
-    return await asyncio.wait_for(loop.run_in_executor(None, runner), timeout_ms / 1000)
+def _is_sequence(node: ast.AST) -> bool:
+    if isinstance(node, ast.Constant):
+        return isinstance(node.value, (str, bytes))
+    if isinstance(node, (ast.JoinedStr, ast.List, ast.Tuple, ast.ListComp)):
+        return True
+    if isinstance(node, ast.Call):
+        func = node.func
+        name = func.id if isinstance(func, ast.Name) else func.attr if isinstance(func, ast.Attribute) else None
+        return name in _SEQUENCE_CALLS
+    return False
+
+def _mult_operands(node: ast.AST) -> List[ast.AST]:
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mult):
+        return _mult_operands(node.left) + _mult_operands(node.right)
+    return [node]
+
+def _check_format_sizes(spec: str, widths: "re.Pattern[str]") -> None:
+    for match in widths.finditer(spec):
+        for size in (match.groups() or (match.group(),)):
+            if size == "*":
+                raise ValueError("'*' widths are not allowed in format strings.")
+            if size and int(size) > _MAX_LITERAL_SIZE:
+                raise ValueError(f"Format widths above {_MAX_LITERAL_SIZE} are not allowed.")
+
+class _ExprValidator(ast.NodeVisitor):
+    def __init__(self) -> None:
+        self.node_count = 0
+        self.expanding_replaces = 0
+
+    def visit(self, node: ast.AST) -> Any:
+        self.node_count += 1
+        if self.node_count > _MAX_EXPR_NODES:
+            raise ValueError("Expression is too large. Split it into smaller queries.")
+        return super().visit(node)
+
+    def visit_Name(self, node: ast.Name) -> None:
+        if node.id.startswith("__"):
+            raise ValueError(f"Name '{node.id}' is not allowed.")
+
+    def visit_Attribute(self, node: ast.Attribute) -> None:
+        if node.attr not in _ALLOWED_METHODS:
+            allowed = ", ".join(sorted(_ALLOWED_METHODS))
+            raise ValueError(f"Attribute '.{node.attr}' is not allowed. Allowed methods: {allowed}.")
+        self.generic_visit(node)
+
+    def visit_Call(self, node: ast.Call) -> None:
+        func = node.func
+        if isinstance(func, ast.Name):
+            if func.id not in ALLOWED_BUILTINS:
+                raise ValueError(f"Calling '{func.id}' is not allowed; only the listed builtins can be called.")
+            if func.id == "range" and any((_literal_size(arg) or 0) > _MAX_LITERAL_SIZE for arg in node.args):
+                raise ValueError(f"range() bounds above {_MAX_LITERAL_SIZE} are not allowed.")
+        elif not isinstance(func, ast.Attribute):
+            raise ValueError("Only allowed builtins and methods can be called.")
+        elif func.attr == "replace" and len(node.args) >= 2:
+            self._visit_replace(node.args[0], node.args[1])
+        self.visit(func)
+        for arg in node.args:
+            self.visit(arg)
+        for kw in node.keywords:
+            if kw.arg == "key" and isinstance(kw.value, ast.Lambda):
+                # Visit the lambda's arguments and body, not the Lambda node itself
+                self.generic_visit(kw.value)
+            else:
+                self.visit(kw.value)
+
+    def _visit_replace(self, old: ast.AST, new: ast.AST) -> None:
+        # Each growing replace multiplies the length, so chains of them are rejected
+        if not (isinstance(new, ast.Constant) and isinstance(new.value, str)):
+            raise ValueError("The replacement passed to .replace() must be a string literal.")
+        old_len = len(old.value) if isinstance(old, ast.Constant) and isinstance(old.value, str) else 1
+        if len(new.value) > old_len:
+            self.expanding_replaces += 1
+            if self.expanding_replaces > 1:
+                raise ValueError("At most one .replace() that lengthens the text is allowed per expression.")
+
+    def visit_BinOp(self, node: ast.BinOp) -> None:
+        if isinstance(node.op, (ast.Pow, ast.LShift)):
+            raise ValueError("'**' and '<<' are not allowed in a query expression.")
+        if isinstance(node.op, ast.Mult):
+            operands = _mult_operands(node)
+            sizes = [_literal_size(operand) for operand in operands]
+            factor = 1
+            for size in sizes:
+                factor = min(factor * (size if size is not None else 1), _FOLD_CAP)
+            if factor > _MAX_LITERAL_SIZE:
+                raise ValueError(f"Multiplying by constants above {_MAX_LITERAL_SIZE} is not allowed.")
+            if any(map(_is_sequence, operands)) and sum(size is None for size in sizes) > 1:
+                raise ValueError("A string or list can only be repeated by an integer literal, e.g. '-' * 20.")
+        elif isinstance(node.op, ast.Mod) and isinstance(node.left, ast.Constant) and isinstance(node.left.value, str):
+            _check_format_sizes(node.left.value, _FORMAT_SPEC)
+        self.generic_visit(node)
+
+    def visit_FormattedValue(self, node: ast.FormattedValue) -> None:
+        if node.format_spec is not None:
+            for part in node.format_spec.values:
+                if not isinstance(part, ast.Constant):
+                    raise ValueError("Nested replacement fields in f-string format specs are not allowed.")
+                _check_format_sizes(part.value, _DIGITS)
+        self.generic_visit(node)
+
+    def visit_Lambda(self, node: ast.Lambda) -> None:
+        raise ValueError("lambda is only allowed as the key= argument of sorted/min/max.")
+
+    def _visit_comprehension(self, node: ast.AST) -> None:
+        if len(node.generators) > _MAX_COMPREHENSION_GENERATORS:
+            raise ValueError(f"At most {_MAX_COMPREHENSION_GENERATORS} 'for' clauses per comprehension.")
+        self.generic_visit(node)
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_comprehension
+
+    def _reject(self, node: ast.AST) -> None:
+        raise ValueError(f"{type(node).__name__} is not allowed in a query expression.")
+
+    visit_NamedExpr = visit_Yield = visit_YieldFrom = visit_Await = _reject
+
+def _validate_ast(tree: ast.AST) -> None:
+    _ExprValidator().visit(tree)
+
+def _build_code(expr: str):
+    bad = _prevalidate_expr(expr)
+    if bad:
+        raise ValueError(bad)
+    tree = ast.parse(expr, mode="eval")
+    _validate_ast(tree)
+    return compile(tree, "<expr>", "eval")
+
+# Compiled code objects are cached per expression; the model often repeats queries within a session.
+# Very long expressions are compiled fresh so they cannot crowd out the cache. Rejected expressions
+# raise, so they are never cached.
+_MAX_CACHED_EXPR_LEN = 4096
+
+@lru_cache(maxsize=512)
+def _compile_cached(expr: str):
+    return _build_code(expr)
+
+def _compile_expr(expr: str):
+    if len(expr) > _MAX_CACHED_EXPR_LEN:
+        return _build_code(expr)
+    return _compile_cached(expr)
+
+# - Expression worker pool -
+# dataset_query expressions run in worker processes: a runaway expression is killed on timeout
+# instead of pinning a server thread (and the GIL). Workers receive the current run once through
+# the pool initializer; the pool is rebuilt whenever CURRENT_RUN is replaced.
+_EXPR_WORKERS = max(1, int(os.getenv("AGENT_EXPR_WORKERS", "2")))
+# Address space an expression may allocate on top of the worker's baseline (POSIX only; 0 disables)
+_EXPR_MEM_HEADROOM_MB = int(os.getenv("AGENT_EXPR_MEM_MB", "512"))
+
+_EXPR_POOL: Optional[ProcessPoolExecutor] = None
+_EXPR_POOL_RUN: Optional[Dict[str, Any]] = None
+_EXPR_POOL_READY: Optional["asyncio.Future[List[bool]]"] = None
+# In-flight expressions are capped at the worker count, so a job's timeout only starts once a worker
+# is free to run it instead of while it waits in the pool's queue. Created on (and tied to) the loop.
+_EXPR_SLOTS: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore]] = None
+# Pools terminated because one of their expressions timed out; their other jobs are rerun, not blamed
+_TIMED_OUT_POOLS: "weakref.WeakSet[ProcessPoolExecutor]" = weakref.WeakSet()
+
+# Worker-process state (set by _worker_init). Variables live in the eval globals so that
+# comprehension bodies can reference them too (e.g. columns[...] inside a list comprehension).
+_WORKER_GLOBALS: Dict[str, Any] = {}
+
+def _worker_init(run: Dict[str, Any]) -> None:
+    global _WORKER_GLOBALS
+    questions = _normalize_questions(run)
+    _WORKER_GLOBALS = {
+        # Plain dict copy: CPython only uses its fast builtin lookup path for exact dicts
+        "__builtins__": dict(ALLOWED_BUILTINS),
+        "data": run,
+        "questions": questions,
+        "columns": _build_run_columns(questions),
+    }
+    if resource is None or _EXPR_MEM_HEADROOM_MB <= 0:
+        return
+    try:
+        with open("/proc/self/statm") as f:
+            baseline = int(f.read().split()[0]) * resource.getpagesize()
+        cap = baseline + _EXPR_MEM_HEADROOM_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+    except (OSError, ValueError):
+        # No /proc (e.g. macOS) or limit not permitted: rely on the timeout only
+        pass
+
+def _worker_ping() -> bool:
+    return True
+
+def _worker_query(expr: str, limit: Optional[int], char_limit: Optional[int], timeout_ms: int) -> Tuple[Any, bool, bool]:
+    if resource is not None:
+        # CPU backstop in case the parent cannot stop us: SIGXCPU terminates the worker
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(usage.ru_utime + usage.ru_stime) + math.ceil(timeout_ms / 1000) + 1
+        try:
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+        except (OSError, ValueError):
+            pass
+    code = _compile_expr(expr)
+    value = eval(code, _WORKER_GLOBALS)
+    # Shape the result here so only the capped, JSON-safe value is sent back to the server
+    return _finalize(value, limit, char_limit)
+
+def _shutdown_expr_pool(pool: Optional[ProcessPoolExecutor], kill: bool = False) -> None:
+    global _EXPR_POOL, _EXPR_POOL_RUN, _EXPR_POOL_READY
+    if pool is None:
+        return
+    if pool is _EXPR_POOL:
+        _EXPR_POOL = _EXPR_POOL_RUN = _EXPR_POOL_READY = None
+    if kill:
+        # Running work cannot be cancelled on a ProcessPoolExecutor; terminate its workers instead
+        for proc in list((getattr(pool, "_processes", None) or {}).values()):
+            proc.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+async def _get_expr_pool(run: Dict[str, Any]) -> ProcessPoolExecutor:
+    global _EXPR_POOL, _EXPR_POOL_RUN, _EXPR_POOL_READY
+    if _EXPR_POOL is None or _EXPR_POOL_RUN is not run:
+        _shutdown_expr_pool(_EXPR_POOL)
+        _EXPR_POOL = ProcessPoolExecutor(max_workers=_EXPR_WORKERS, initializer=_worker_init, initargs=(run,))
+        _EXPR_POOL_RUN = run
+        # Worker start-up (and shipping the run) happens here, outside the per-expression timeout.
+        # One ping per worker: spawn-based platforms (Windows, macOS) only start workers on demand.
+        loop = asyncio.get_running_loop()
+        _EXPR_POOL_READY = asyncio.gather(*(loop.run_in_executor(_EXPR_POOL, _worker_ping) for _ in range(_EXPR_WORKERS)))
+    pool = _EXPR_POOL
+    try:
+        await asyncio.shield(_EXPR_POOL_READY)
+    except Exception:
+        # Workers failed to start (e.g. the initializer raised); drop the pool so the next query rebuilds it
+        _shutdown_expr_pool(pool, kill=True)
+        raise
+    return pool
+
+def _expr_slots() -> asyncio.Semaphore:
+    global _EXPR_SLOTS
+    loop = asyncio.get_running_loop()
+    if _EXPR_SLOTS is None or _EXPR_SLOTS[0] is not loop:
+        _EXPR_SLOTS = (loop, asyncio.Semaphore(_EXPR_WORKERS))
+    return _EXPR_SLOTS[1]
+
+async def _eval_expr(expr: str, run: Dict[str, Any], limit: Optional[int], char_limit: Optional[int],
+                     timeout_ms: int = 400) -> Tuple[Any, bool, bool]:
+    async with _expr_slots():
+        retried = False
+        while True:
+            pool = await _get_expr_pool(run)
+            fut = asyncio.get_running_loop().run_in_executor(pool, _worker_query, expr, limit, char_limit, timeout_ms)
+            try:
+                return await asyncio.wait_for(fut, timeout_ms / 1000)
+            except asyncio.TimeoutError:
+                _TIMED_OUT_POOLS.add(pool)
+                _shutdown_expr_pool(pool, kill=True)
+                raise TimeoutError(f"Expression exceeded {timeout_ms} ms and was stopped. Narrow the query.")
+            except MemoryError:
+                # RLIMIT_AS tripped inside the worker; the worker itself survives
+                raise MemoryError("Expression exceeded the worker memory limit. Narrow the query.")
+            except BrokenProcessPool:
+                if pool in _TIMED_OUT_POOLS and not retried:
+                    # Stopped because a concurrent expression timed out: run it again on a fresh pool
+                    retried = True
+                    continue
+                _shutdown_expr_pool(pool, kill=True)
+                raise RuntimeError("Expression worker died (resource limit exceeded). Narrow the query.")
+
+def _stop_expr_pool() -> None:
+    _shutdown_expr_pool(_EXPR_POOL, kill=True)
+
+router.add_event_handler("shutdown", _stop_expr_pool)
 
 
 def _normalize_questions(run: Dict[str, Any]) -> List[Dict[str, Any]]:
@@ -134,86 +455,289 @@ def _normalize_questions(run: Dict[str, Any]) -> List[Dict[str, Any]]:
     return results
 
 
-def _truncate_strings(value: Any, char_limit: Optional[int]) -> (Any, bool):
-    if char_limit is None:
-        return value, False
-    truncated_any = False
-    if isinstance(value, str):
-        if len(value) > char_limit:
-            return value[:char_limit], True
-        return value, False
-    if isinstance(value, list):
-        new_list = []
-        for item in value:
-            new_item, t = _truncate_strings(item, char_limit)
-            truncated_any = truncated_any or t
-            new_list.append(new_item)
-        return new_list, truncated_any
-    if isinstance(value, tuple):
-        new_items = []
-        for item in value:
-            new_item, t = _truncate_strings(item, char_limit)
-            truncated_any = truncated_any or t
-            new_items.append(new_item)
-        return tuple(new_items), truncated_any
-    if isinstance(value, dict):
-        new_dict = {}
-        for k, v in value.items():
-            new_v, t = _truncate_strings(v, char_limit)
-            truncated_any = truncated_any or t
-            new_dict[k] = new_v
-        return new_dict, truncated_any
-    return value, False
+def _build_run_columns(questions: List[Dict[str, Any]]) -> Dict[str, Tuple[Any, ...]]:
+    """Columnar view of per-question fields, built in one pass per run in each worker.
+
+    Every column is aligned with `questions`. Metric columns cover the union of per-question metric
+    names (None where a question lacks one). Entries that are not dicts count as empty questions.
+    """
+    def count(value: Any) -> int:
+        return len(value) if isinstance(value, list) else 0
+
+    columns: Dict[str, List[Any]] = {
+        "query_ids": [], "num_chunks": [], "num_response_claims": [], "num_gt_claims": [],
+    }
+    metric_columns: Dict[str, List[Any]] = {}
+    for i, q in enumerate(questions):
+        if not isinstance(q, dict):
+            # Runs in the pool initializer: one malformed entry must not take down every worker
+            q = {}
+        columns["query_ids"].append(q.get("query_id"))
+        columns["num_chunks"].append(count(q.get("retrieved_context")))
+        columns["num_response_claims"].append(count(q.get("response_claims")))
+        columns["num_gt_claims"].append(count(q.get("gt_answer_claims")))
+        metrics = q.get("metrics")
+        if isinstance(metrics, dict):
+            for name, value in metrics.items():
+                metric_columns.setdefault(name, [None] * i).append(value)
+        for column in metric_columns.values():
+            if len(column) == i:
+                column.append(None)
+
+    for name, column in metric_columns.items():
+        columns.setdefault(name, column)
+    # Tuples: a query cannot sort/mutate a column in place and affect later queries
+    return {name: tuple(column) for name, column in columns.items()}
+
+
+_SEQUENCE_TYPES = (list, tuple, set, frozenset)
+_CONTAINER_TYPES = _SEQUENCE_TYPES + (dict,)
+_JSON_LEAF_TYPES = (str, int, float, bool)
+
+def _finalize(value: Any, limit: Optional[int], char_limit: Optional[int]) -> Tuple[Any, bool, bool]:
+    """Apply the top-level row limit, char truncation and JSON sanitizing in one traversal.
+
+    Returns (value, list_truncated, char_truncated). Sets/tuples become lists; non-JSON keys and
+    leaves become str. Containers that need no change keep their original reference.
+    """
+    list_truncated = False
+    if isinstance(value, _SEQUENCE_TYPES) and limit is not None and len(value) > limit:
+        value = list(islice(value, limit))
+        list_truncated = True
+
+    char_truncated = False
+
+    def leaf(v: Any) -> Any:
+        nonlocal char_truncated
+        if v is None or isinstance(v, (int, float, bool)):
+            return v
+        if not isinstance(v, str):
+            v = str(v)
+        if char_limit is not None and len(v) > char_limit:
+            char_truncated = True
+            return v[:char_limit]
+        return v
+
+    if not isinstance(value, _CONTAINER_TYPES):
+        value = leaf(value)
+        return value, list_truncated, char_truncated
+    if isinstance(value, list) and all(x is None or isinstance(x, (int, float, bool)) for x in value):
+        # Flat list of numbers/bools (e.g. per-question scores): nothing to walk
+        return value, list_truncated, False
+
+    # Iterative post-order walk. A container is rebuilt only if it is not a list/dict or a
+    # descendant changed; untouched subtrees keep their original references.
+    # Frame: [node, child iterator, rebuilt children, changed, key in parent]
+    def new_frame(node: Any, key: Any) -> list:
+        if isinstance(node, dict):
+            return [node, iter(node.items()), [], False, key]
+        return [node, iter(node), [], not isinstance(node, list), key]
+
+    stack = [new_frame(value, None)]
+    while True:
+        frame = stack[-1]
+        node, items, out = frame[0], frame[1], frame[2]
+        is_dict = isinstance(node, dict)
+        descended = False
+        for item in items:
+            if is_dict:
+                key, child = item
+                if not (key is None or isinstance(key, _JSON_LEAF_TYPES)):
+                    key = str(key)
+                    frame[3] = True
+            else:
+                key, child = None, item
+            if isinstance(child, _CONTAINER_TYPES):
+                stack.append(new_frame(child, key))
+                descended = True
+                break
+            new_child = leaf(child)
+            if new_child is not child:
+                frame[3] = True
+            out.append((key, new_child) if is_dict else new_child)
+        if descended:
+            continue
+
+        stack.pop()
+        if not frame[3]:
+            built = node
+        elif is_dict:
+            built = dict(out)
+        else:
+            built = out
+        if not stack:
+            return built, list_truncated, char_truncated
+        parent = stack[-1]
+        if built is not node:
+            parent[3] = True
+        parent[2].append((frame[4], built) if isinstance(parent[0], dict) else built)
+
+_COMPARISON_NEIGHBOURS = frozenset("=!<>")
 
 def _prevalidate_expr(expr: str) -> Optional[str]:
-    # Disallow obvious non-expression forms: assignments, semicolons, newlines
-    if ';' in expr:
-        return "Only a single expression is allowed. Do not use semicolons."
-    if '\n' in expr:
+    # Disallow obvious non-expression forms: assignments, semicolons, newlines.
+    # Single pass: a '=' counts as assignment unless it is part of ==, >=, <=, != or a
+    # keyword argument inside brackets (walrus ':=' is always rejected). '=' and brackets inside
+    # string literals are skipped; semicolons and newlines are rejected anywhere.
+    has_newline = False
+    has_assignment = False
+    depth = 0
+    quote = ""  # delimiter of the string literal being scanned (a quote or a triple quote)
+    last = len(expr) - 1
+    i = 0
+    while i <= last:
+        ch = expr[i]
+        if ch == ';':
+            return "Only a single expression is allowed. Do not use semicolons."
+        if ch == '\n':
+            has_newline = True
+        elif quote:
+            if ch == '\\':
+                i += 1  # escaped character
+            elif expr.startswith(quote, i):
+                i += len(quote) - 1
+                quote = ""
+        elif ch in '\'"':
+            quote = ch * 3 if expr.startswith(ch * 3, i) else ch
+            i += len(quote) - 1
+        elif ch in '([{':
+            depth += 1
+        elif ch in ')]}':
+            depth -= 1
+        elif ch == '=' and not has_assignment:
+            prev_ch = expr[i - 1] if i > 0 else ''
+            next_ch = expr[i + 1] if i < last else ''
+            if prev_ch == ':' or (depth <= 0 and prev_ch not in _COMPARISON_NEIGHBOURS and next_ch != '='):
+                has_assignment = True
+        i += 1
+    if has_newline:
         return "Only a single expression is allowed. Do not use newlines."
-    # crude check for assignment '=' not part of comparisons
-    if '=' in expr and '==' not in expr and '>=' not in expr and '<=' not in expr and '!=' not in expr:
+    if has_assignment:
         return "Only a single expression is allowed. Do not use assignments (e.g., no q=...)."
     return None
 
 async def _run_dataset_query(expr: str, limit: Optional[int], char_limit: Optional[int]) -> Dict[str, Any]:
     if CURRENT_RUN is None:
         raise HTTPException(status_code=400, detail="No run loaded. Include run_data in the request once after loading a run.")
-    questions = _normalize_questions(CURRENT_RUN)
-    ctx = {"data": CURRENT_RUN, "questions": questions}
 
-    value = await _eval_expr(expr, ctx, timeout_ms=400)
+    # Row limit, char truncation and JSON sanitizing run in the worker (one pass, see _finalize);
+    # the actual encode happens once, when the tool message is built
+    value, list_truncated, char_truncated = await _eval_expr(expr, CURRENT_RUN, limit, char_limit, timeout_ms=400)
 
-    list_truncated = False
-    if isinstance(value, list) and limit is not None and len(value) > limit:
-        value = value[:limit]
-        list_truncated = True
+    return {"result": value, "truncated": list_truncated, "char_truncated": char_truncated}
 
-    # Optional char-level truncation
-    value, char_truncated = _truncate_strings(value, char_limit)
 
-    # Ensure JSON serializable
+def _json_bytes(obj: Any) -> bytes:
     try:
-        json.dumps(value)
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
     except TypeError:
-        if isinstance(value, (set, tuple)):
-            value = list(value)
-        else:
-            value = str(value)
-
-    return {"result": value, "truncated": list_truncated, "char_truncated": char_truncated}
-
+        # orjson rejects e.g. integers beyond 64 bits; stdlib json handles them
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def _json_text(obj: Any) -> str:
+    return _json_bytes(obj).decode("utf-8")
+
+def _sse(data: Any, event: Optional[str] = None) -> bytes:
+    frame = b"data: " + _json_bytes(data) + b"\n\n"
+    if event:
+        return b"event: " + event.encode("utf-8") + b"\n" + frame
+    return frame
+
+
+# Only the most recent tool results are re-sent to the LLM verbatim; older ones are cut down to a
+# short summary once they age out. The client transcript keeps them in full (frames are sent first).
+TOOL_RESULTS_VERBATIM = 3
+TOOL_SUMMARY_CHARS = 200
+
+def _compact_tool_result(msg: Dict[str, Any]) -> None:
+    content = msg.get("content") or ""
+    if len(content) > TOOL_SUMMARY_CHARS:
+        msg["content"] = _json_text({"summary": content[:TOOL_SUMMARY_CHARS], "truncated": True})
+
+
+# Streamed answer frames are flushed once this many bytes are buffered, or this long after the first
+# buffered byte, whichever comes first
+SSE_FLUSH_BYTES = 4096
+SSE_FLUSH_SEC = 0.015
+
+async def _coalesce_frames(frames: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Batch small SSE frames into larger writes without delaying any frame by more than SSE_FLUSH_SEC."""
+    loop = asyncio.get_running_loop()
+    it = frames.__aiter__()
+    buf = bytearray()
+    deadline = 0.0
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(it.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if buf else None
+            done, _ = await asyncio.wait((pending,), timeout=timeout)
+            if not done:
+                # Source is idle: flush what we have and keep waiting for the same frame
+                yield bytes(buf)
+                buf.clear()
+                continue
+            fut, pending = pending, None
+            try:
+                frame = fut.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                if buf:
+                    yield bytes(buf)
+                raise
+            if not buf:
+                deadline = loop.time() + SSE_FLUSH_SEC
+            buf += frame
+            if len(buf) >= SSE_FLUSH_BYTES:
+                yield bytes(buf)
+                buf.clear()
+        if buf:
+            yield bytes(buf)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+# Shared client for the loader endpoint; keeps the loopback connection alive between chats
+_LOADER_CLIENT: Optional[httpx.AsyncClient] = None
+
+def _get_loader_client() -> httpx.AsyncClient:
+    global _LOADER_CLIENT
+    if _LOADER_CLIENT is None or _LOADER_CLIENT.is_closed:
+        _LOADER_CLIENT = httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=4))
+    return _LOADER_CLIENT
+
+async def _close_loader_client() -> None:
+    global _LOADER_CLIENT
+    client, _LOADER_CLIENT = _LOADER_CLIENT, None
+    if client is not None:
+        await client.aclose()
+
+router.add_event_handler("shutdown", _close_loader_client)
+
+# In-process run loader registered by the host app (main.load_run). When set, runs are read
+# directly instead of through an HTTP round-trip to our own loader endpoint.
+_RUN_LOADER: Optional[Callable[[str, str, bool], Dict[str, Any]]] = None
+
+def register_run_loader(loader: Callable[[str, str, bool], Dict[str, Any]]) -> None:
+    global _RUN_LOADER
+    _RUN_LOADER = loader
 
 async def _fetch_run_via_loader(src: SourceSpec, timeout_sec: float) -> Dict[str, Any]:
-    """Fetch run via existing backend loader endpoint, honoring derived flag."""
+    """Fetch run via the backend loader (in-process if registered, else HTTP), honoring derived flag."""
+    if _RUN_LOADER is not None:
+        logger.info("Agent: loading run in-process %s/%s (derived=%s)", src.collection, src.run_file, bool(src.derived))
+        # Loader does blocking file I/O and derive work; keep it off the event loop
+        return await run_in_threadpool(_RUN_LOADER, src.collection, src.run_file, bool(src.derived))
     url = f"http://127.0.0.1:8000/collections/{src.collection}/runs/{src.run_file}"
     if src.derived:
         url += "?derived=true"
-    logger.info(f"Agent: fetching run via loader {url}")
-    async with httpx.AsyncClient(timeout=timeout_sec) as client:
-        resp = await client.get(url)
-        resp.raise_for_status()
-        return resp.json()
+    logger.info("Agent: fetching run via loader %s", url)
+    resp = await _get_loader_client().get(url, timeout=timeout_sec)
+    resp.raise_for_status()
+    return orjson.loads(await resp.aread())
 
 @router.post("/chat/stream")
 async def chat_stream(body: ChatRequest):
@@ -222,16 +746,19 @@ async def chat_stream(body: ChatRequest):
     # Load env 
     model = os.getenv("LLM_NAME")
     if not model:
-        logger.error(f"LLM_NAME is not set in environment")
+        logger.error("LLM_NAME is not set in environment")
         raise HTTPException(status_code=500, detail="LLM_NAME is not set in environment")
     api_base = os.getenv("LLM_PROVIDER_API_BASE", os.getenv("LLM_API_BASE", "https://api.openai.com/v1"))
     api_key = os.getenv("LLM_PROVIDER_API_KEY", os.getenv("LLM_API_KEY"))
     timeout_sec = float(os.getenv("LLM_TIMEOUT_SEC", "100"))
 
-    logger.info(
-        f"chat request: tab={body.active_tab} "
-        f"msgs={len(body.messages) if body.messages else 0} view_keys={sorted(body.view_context.keys()) if body.view_context else []}"
-    )
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "chat request: tab=%s msgs=%d view_keys=%s",
+            body.active_tab,
+            len(body.messages) if body.messages else 0,
+            sorted(body.view_context.keys()) if body.view_context else [],
+        )
 
     if not api_key:
         raise HTTPException(status_code=400, detail="Missing LLM_PROVIDER_API_KEY in environment")
@@ -241,14 +768,14 @@ async def chat_stream(body: ChatRequest):
         src = body.source
         try:
             CURRENT_RUN = await _fetch_run_via_loader(src, timeout_sec)
-            logger.info(f"Agent: loaded run from loader (derived={src.derived})")
+            logger.info("Agent: loaded run from loader (derived=%s)", src.derived)
         except Exception as e:
-            logger.error(f"[Agent: failed to load run from loader: {e}")
+            logger.error("[Agent: failed to load run from loader: %s", e)
             raise HTTPException(status_code=502, detail="Failed to fetch run from loader")
 
     # Build messages array
     sys_prompt = build_prompt_for_tab(body.active_tab, body.view_context)
-    logger.info(f"[=== SYSTEM PROMPT ===\n{sys_prompt}")
+    logger.info("[=== SYSTEM PROMPT ===\n%s", sys_prompt)
     messages: List[Dict[str, Any]] = [{"role": "system", "content": sys_prompt}]
     last_user = None
     for m in body.messages:
@@ -275,162 +802,204 @@ async def chat_stream(body: ChatRequest):
             if m.role == "user":
                 last_user = m.content or ""
     if last_user:
-        logger.info(f"[ === USER INPUT ===\n{last_user}")
+        logger.info("[ === USER INPUT ===\n%s", last_user)
+    # Tool results still sent verbatim, oldest first
+    verbatim_tool_msgs = deque(msg for msg in messages if msg["role"] == "tool")
 
-    # Iterative tool-use loop: allow the model to call the tool up to 7 times before final answer
+    # Iterative tool-use loop: allow the model up to 7 tool turns (each with up to 5 calls) before final answer
     MAX_STEPS = 7
+    MAX_CALLS_PER_TURN = 5
 
-    async def sse_generator() -> Iterable[bytes]:
+    async def sse_events() -> AsyncIterator[bytes]:
         # === TOOL LOOP ===
+        # Every turn is one streaming call: answer text is forwarded as it arrives, tool-call deltas
+        # are accumulated and executed when the turn ends. A turn without tool calls is the answer.
         tool_steps = 0
-        tool_used = False
-        tool_call_id: Optional[str] = None
         extra_grace_used = False
-        while tool_steps < (MAX_STEPS + (1 if extra_grace_used else 0)):
-            # Non-stream call with tools enabled
+        tools_disabled = False
+        # Results of identical dataset_query calls within this request (the model often repeats itself)
+        local_cache: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        latest_turn_results = 0
+        while True:
+            tools_allowed = not tools_disabled and tool_steps < (MAX_STEPS + (1 if extra_grace_used else 0))
+            if not tools_allowed:
+                logger.info("[ final: streaming answer (tool_choice=none)")
+            # Results of the latest turn are never compacted before the model has seen them
+            while len(verbatim_tool_msgs) > max(TOOL_RESULTS_VERBATIM, latest_turn_results):
+                _compact_tool_result(verbatim_tool_msgs.popleft())
             try:
-                resp = await acompletion(
+                # tool_choice="none" explicitly disables new tool calls during final answer
+                stream = await acompletion(
                     model=model,
                     api_base=api_base,
                     api_key=api_key,
                     timeout=timeout_sec,
                     messages=messages,
                     tools=TOOLS,
-                    tool_choice="auto",
-                    stream=False,
+                    tool_choice="auto" if tools_allowed else "none",
+                    stream=True,
                 )
             except Exception as e:
-                err = f"LLM call failed during tool loop: {e}"
-                logger.error(f"[[TOOL-LOOP-ERROR] {err}")
-                yield f"data: {json.dumps({"error": err})}\n\n".encode("utf-8")
+                if tools_allowed:
+                    err = f"LLM call failed during tool loop: {e}"
+                    logger.error("[[TOOL-LOOP-ERROR] %s", err)
+                    yield _sse({"error": err})
+                else:
+                    logger.error("[ [FINAL-STREAM-ERROR] %s", e)
+                    yield _sse({"error": "Final LLM call failed"})
                 return
 
-            msg = resp.choices[0].message
-            tool_calls = getattr(msg, "tool_calls", None)
-            if not tool_calls:
-                logger.info(f"[tool loop: no tool call (will stream final)")
-                break
+            text_parts: List[str] = []
+            # Tool-call deltas by index: {"id", "name", "arguments"}; arguments arrive in fragments
+            call_parts: Dict[int, Dict[str, Any]] = {}
+            stream_error: Optional[Exception] = None
+            try:
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta
+                    text = getattr(delta, "content", None)
+                    if text:
+                        text_parts.append(text)
+                        yield _sse({"content": text})
+                    if not tools_allowed:
+                        continue
+                    for tc in getattr(delta, "tool_calls", None) or []:
+                        part = call_parts.setdefault(getattr(tc, "index", None) or 0, {"id": None, "name": "", "arguments": ""})
+                        if getattr(tc, "id", None):
+                            part["id"] = tc.id
+                        fn = getattr(tc, "function", None)
+                        if fn is not None:
+                            if getattr(fn, "name", None) and not part["name"]:
+                                part["name"] = fn.name
+                            if getattr(fn, "arguments", None):
+                                part["arguments"] += fn.arguments
+            except Exception as e:
+                logger.error("[ [STREAM-EMIT-ERROR] %s", e)
+                stream_error = e
+
+            if stream_error is not None:
+                if tools_allowed:
+                    # Same frame as a failed tool-loop call: the turn is incomplete, so do not report done
+                    yield _sse({"error": f"LLM call failed during tool loop: {stream_error}"})
+                    return
+                yield _sse({"error": "Final LLM call failed"})
+
+            if stream_error is not None or not call_parts:
+                if tools_allowed:
+                    logger.info("[tool loop: no tool call (streamed final)")
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("[ === FINAL ANSWER ===\n%s", "".join(text_parts))
+                yield b"event: done\ndata: {}\n\n"
+                return
 
-            call = tool_calls[0]
-            fn = getattr(call, "function", None)
-            name = getattr(fn, "name", None) if fn else None
-            args_raw = getattr(fn, "arguments", "{}") if fn else "{}"
-            tool_call_id = getattr(call, "id", None)
-            logger.info(f"[tool loop: assistant requested tool name={name} args={json.dumps(args_raw, indent=4)}")
+            # The prompt allows several tool calls per turn; they are answered in index order
+            calls = [call_parts[i] for i in sorted(call_parts)][:MAX_CALLS_PER_TURN]
+            if logger.isEnabledFor(logging.INFO):
+                for call in calls:
+                    logger.info("[tool loop: assistant requested tool name=%s args=%s", call["name"] or None, json.dumps(call["arguments"], indent=4))
 
-            if name != "dataset_query":
-                logger.info(f"[ tool loop: unknown tool '{name}', stopping tool loop")
-                break
+            unknown = [call["name"] or None for call in calls if call["name"] != "dataset_query"]
+            if unknown:
+                logger.info("[ tool loop: unknown tool '%s', stopping tool loop", unknown[0])
+                tools_disabled = True
+                continue
 
-            # Parse args
+            if text_parts:
+                # Keep any preamble the model streamed before its tool call apart from later text
+                yield _sse({"content": "\n\n"})
+
+            # Parse + validate args in one pass (pydantic-core parses the JSON string directly)
             try:
-                args = json.loads(args_raw)
-                tool_args = ToolCallArgs(**args)
+                parsed_args = [ToolCallArgs.model_validate_json(call["arguments"] or "{}") for call in calls]
             except Exception as e:
                 err = f"Invalid tool arguments: {e}"
-                logger.error(f"[ [TOOL-ARGS-ERROR] {err}")
-                yield f"data: {json.dumps({"error": err})}\n\n".encode("utf-8")
+                logger.error("[ [TOOL-ARGS-ERROR] %s", err)
+                yield _sse({"error": err})
                 return
 
+            call_ids = [call["id"] or f"call_{tool_steps+1}_{i+1}" for i, call in enumerate(calls)]
+
             # Append assistant tool_call message
             assistant_tool_msg = {
                 "role": "assistant",
-                "content": None,
+                "content": "".join(text_parts) or None,
                 "tool_calls": [
                     {
-                        "id": tool_call_id or f"call_{tool_steps+1}",
+                        "id": call_id,
                         "type": "function",
                         "function": {
-                            "name": name,
-                            "arguments": json.dumps(args)
+                            "name": "dataset_query",
+                            "arguments": tool_args.model_dump_json(exclude_unset=True)
                         }
                     }
+                    for call_id, tool_args in zip(call_ids, parsed_args)
                 ]
             }
             messages.append(assistant_tool_msg)
             # Stream tool_call to client for persistence
-            yield f"event: tool_call\ndata: {json.dumps(assistant_tool_msg, ensure_ascii=False)}\n\n".encode("utf-8")
-
-            # Execute dataset_query (with prevalidation)
-            bad = _prevalidate_expr(tool_args.expr)
-            if bad:
-                err_msg = {"error": bad, "hint": "Write ONE expression: no assignments/semicolons/newlines."}
-                logger.error(f"[ === TOOL ERROR (step {tool_steps+1}) ===\n{bad}")
-                tool_msg_err = {"role": "tool", "name": "dataset_query", "content": json.dumps(err_msg, ensure_ascii=False)}
-                if tool_call_id:
-                    tool_msg_err["tool_call_id"] = tool_call_id
-                messages.append(tool_msg_err)
-                yield f"event: tool_result\ndata: {json.dumps(tool_msg_err, ensure_ascii=False)}\n\n".encode("utf-8")
-                if not extra_grace_used:
-                    extra_grace_used = True
-                tool_steps += 1
-                continue
-            try:
-                logger.info(f"[ === TOOL INPUT (step {tool_steps+1}) ===\nexpr={tool_args.expr}\nlimit={tool_args.limit}\nchar_limit={tool_args.char_limit}")
-                tool_result = await _run_dataset_query(tool_args.expr, tool_args.limit, tool_args.char_limit)
-                logger.info(f"[ === TOOL OUTPUT (step {tool_steps+1}) ===\n{json.dumps(tool_result, ensure_ascii=False)}")
-            except Exception as e:
-                # Create an error tool result instead of failing the whole request
-                err_msg = {"error": str(e), "hint": "Ensure a single expression; avoid assignments/semicolons/newlines."}
-                logger.error(f"[ === TOOL ERROR (step {tool_steps+1}) ===\n{str(e)}")
-                tool_msg_err = {"role": "tool", "name": "dataset_query", "content": json.dumps(err_msg, ensure_ascii=False)}
-                if tool_call_id:
-                    tool_msg_err["tool_call_id"] = tool_call_id
-                messages.append(tool_msg_err)
-                yield f"event: tool_result\ndata: {json.dumps(tool_msg_err, ensure_ascii=False)}\n\n".encode("utf-8")
-                if not extra_grace_used:
-                    extra_grace_used = True
-                tool_steps += 1
-                continue
-
-            # Append tool result message
-            tool_msg = {
-                "role": "tool",
-                "name": "dataset_query",
-                "content": json.dumps(tool_result, ensure_ascii=False),
-            }
-            if tool_call_id:
-                tool_msg["tool_call_id"] = tool_call_id
-            messages.append(tool_msg)
-            # Stream tool_result to client
-            yield f"event: tool_result\ndata: {json.dumps(tool_msg, ensure_ascii=False)}\n\n".encode("utf-8")
-
-            tool_used = True
-            tool_steps += 1
-
-        # FINAL STREAM 
-        try:
-            logger.info(f"[ final: streaming answer (tool_choice=none)")
-            # tool_choice="none" explicitly disables new tool calls during final answer
-            stream = await acompletion(
-                model=model,
-                api_base=api_base,
-                api_key=api_key,
-                timeout=timeout_sec,
-                messages=messages,
-                tools=TOOLS,
-                tool_choice="none",
-                stream=True,
+            yield _sse(assistant_tool_msg, "tool_call")
+
+            # Execute dataset_query calls (with prevalidation). Distinct uncached queries run
+            # concurrently on the expression worker pool.
+            prevalidation_errors: Dict[int, str] = {}
+            cache_keys: List[Optional[Tuple[Any, ...]]] = []
+            jobs: Dict[Tuple[Any, ...], ToolCallArgs] = {}
+            for i, tool_args in enumerate(parsed_args):
+                bad = _prevalidate_expr(tool_args.expr)
+                if bad:
+                    prevalidation_errors[i] = bad
+                    cache_keys.append(None)
+                    continue
+                logger.info("[ === TOOL INPUT (step %d, call %d) ===\nexpr=%s\nlimit=%s\nchar_limit=%s", tool_steps + 1, i + 1, tool_args.expr, tool_args.limit, tool_args.char_limit)
+                cache_key = (id(CURRENT_RUN), tool_args.expr, tool_args.limit, tool_args.char_limit)
+                cache_keys.append(cache_key)
+                if cache_key not in local_cache:
+                    jobs.setdefault(cache_key, tool_args)
+
+            outcomes = await asyncio.gather(
+                *(_run_dataset_query(a.expr, a.limit, a.char_limit) for a in jobs.values()),
+                return_exceptions=True,
             )
-        except Exception as e:
-            logger.error(f"[ [FINAL-STREAM-ERROR] {e}")
-            yield f"data: {json.dumps({"error": "Final LLM call failed"})}\n\n".encode("utf-8")
-            return
-
-        final_text_parts: List[str] = []
-        try:
-            async for chunk in stream:
-                delta = chunk.choices[0].delta
-                text = getattr(delta, "content", None)
-                if text:
-                    final_text_parts.append(text)
-                    yield f"data: {json.dumps({"content": text})}\n\n".encode("utf-8")
-        except Exception as e:
-            logger.error(f"[ [STREAM-EMIT-ERROR] {e}")
-        finally:
-            final_text = "".join(final_text_parts)
-            logger.info(f"[ === FINAL ANSWER ===\n{final_text}")
-            yield b"event: done\ndata: {}\n\n"
+            failures: Dict[Tuple[Any, ...], Exception] = {}
+            for cache_key, outcome in zip(jobs, outcomes):
+                if isinstance(outcome, Exception):
+                    failures[cache_key] = outcome
+                elif isinstance(outcome, BaseException):
+                    raise outcome
+                else:
+                    local_cache[cache_key] = outcome
+
+            for i, (call_id, cache_key) in enumerate(zip(call_ids, cache_keys)):
+                if cache_key is None:
+                    bad = prevalidation_errors[i]
+                    logger.error("[ === TOOL ERROR (step %d, call %d) ===\n%s", tool_steps + 1, i + 1, bad)
+                    payload = {"error": bad, "hint": "Write ONE expression: no assignments/semicolons/newlines."}
+                elif cache_key in failures:
+                    # Report an error tool result instead of failing the whole request
+                    e = failures[cache_key]
+                    logger.error("[ === TOOL ERROR (step %d, call %d) ===\n%s", tool_steps + 1, i + 1, e)
+                    payload = {"error": str(e) or type(e).__name__, "hint": "Ensure a single expression; avoid assignments/semicolons/newlines."}
+                else:
+                    payload = local_cache[cache_key]
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info("[ === TOOL OUTPUT (step %d, call %d) ===\n%s", tool_steps + 1, i + 1, json.dumps(payload, ensure_ascii=False))
+
+                # Append tool result message
+                tool_msg = {
+                    "role": "tool",
+                    "name": "dataset_query",
+                    "content": _json_text(payload),
+                    "tool_call_id": call_id,
+                }
+                messages.append(tool_msg)
+                verbatim_tool_msgs.append(tool_msg)
+                # Stream tool_result to client
+                yield _sse(tool_msg, "tool_result")
+
+            latest_turn_results = len(calls)
+            if prevalidation_errors or failures:
+                extra_grace_used = True
+            tool_steps += 1
 
-    return StreamingResponse(sse_generator(), media_type="text/event-stream")
+    # Frames are coalesced into fewer writes (see _coalesce_frames)
+    return StreamingResponse(_coalesce_frames(sse_events()), media_type="text/event-stream")
 
@@ -536,23 +536,26 @@ const [open, setOpen] = useState<boolean>(false);
                 if (m.role === 'tool' || (m.role === 'assistant' && m.tool_calls)) {
                   // Build chip text
                 if (m.role === 'assistant' && m.tool_calls) {
-                    // Assistant tool-call
-                    const tc = m.tool_calls[0];
-                    let argsPretty = '';
-                    try {
-                      const args = JSON.parse(tc.function.arguments || '{}');
-                      // Format expr on its own line for readability
-                      if (args.expr) {
-                        const { expr, ...rest } = args;
-                        argsPretty = `expr:\n  ${expr}${Object.keys(rest).length > 0 ? '\n' + JSON.stringify(rest, null, 2) : ''}`;
-                      } else {
-                        argsPretty = JSON.stringify(args, null, 2);
-                      }
-                    } catch {}
-                    const label = `${tc.function.name || 'tool'} call`;
+                    // Assistant tool-call: one chip per call (a turn may request several)
                     return (
                       <div key={`${currentSession.id}-${m.id}`} className="agent-tool-steps">
-                        <span className="agent-tool-chip loading" title={argsPretty || 'tool call'}>{label}<span className="meta"> loading…</span></span>
+                        {m.tool_calls.map((tc, j) => {
+                          let argsPretty = '';
+                          try {
+                            const args = JSON.parse(tc.function.arguments || '{}');
+                            // Format expr on its own line for readability
+                            if (args.expr) {
+                              const { expr, ...rest } = args;
+                              argsPretty = `expr:\n  ${expr}${Object.keys(rest).length > 0 ? '\n' + JSON.stringify(rest, null, 2) : ''}`;
+                            } else {
+                              argsPretty = JSON.stringify(args, null, 2);
+                            }
+                          } catch {}
+                          const label = `${tc.function.name || 'tool'} call`;
+                          return (
+                            <span key={tc.id || j} className="agent-tool-chip loading" title={argsPretty || 'tool call'}>{label}<span className="meta"> loading…</span></span>
+                          );
+                        })}
                       </div>
                     );
                   }
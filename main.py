@@ -1,11 +1,19 @@
 import logging
+import hashlib
 import json
 import os
-import copy
+import re
+import threading
+import uuid
 from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice, zip_longest
 from pathlib import Path
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
+import orjson
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
@@ -22,18 +30,13 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 logging.getLogger("litellm").setLevel(logging.WARNING)
-# Suppress noisy third-party logs
-logging.getLogger("httpx").setLevel(logging.WARNING)
-logging.getLogger("httpcore").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
-logging.getLogger("litellm").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Load environment variables from .env if present (project root)
 BASE_DIR = Path(__file__).resolve().parent
 load_dotenv(BASE_DIR / ".env")
 
-app = FastAPI(title="RAG-Debugger Backend", version="1.0.0")
+app = FastAPI(title="RAG-Debugger Backend", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -44,32 +47,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Include agent routes
-try:
-    from agent.routes import router as agent_router
-    app.include_router(agent_router, prefix="/agent")
-    logger.info("Agent routes mounted at /agent")
-except Exception as e:
-    logger.warning(f"Agent routes not mounted: {e}")
-
 COLLECTIONS_DIR = Path("collections")
+# Resolved once; per-request path checks only resolve the collection and run file parts
+_COLLECTIONS_ROOT = COLLECTIONS_DIR.resolve()
 
 # Simple in-memory LRU caches for runs (raw and derived)
 RUN_CACHE_SIZE = 3
-_RUN_CACHE_RAW: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
-_RUN_CACHE_DERIVED: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
-
-def _cache_get(cache: "OrderedDict[Tuple[str, str], Dict[str, Any]]", key: Tuple[str, str]):
-    if key in cache:
-        val = cache.pop(key)
-        cache[key] = val
-        return val
+# Keys are (collection, run_file, source signature), so an edited run file misses instead of going stale
+_RUN_CACHE_RAW: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+_RUN_CACHE_DERIVED: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+# Encoded HTTP responses for the same runs, keyed with the derived flag appended. The dict caches stay:
+# the agent reads runs in-process and keeps its worker pool alive for as long as it sees the same dict.
+_RUN_CACHE_BYTES: "OrderedDict[Tuple[str, str, str, bool], bytes]" = OrderedDict()
+# Sync endpoints run in FastAPI's threadpool, so cache updates must not interleave
+_RUN_CACHE_LOCK = threading.Lock()
+
+def _cache_get(cache: "OrderedDict[Tuple, Any]", key: Tuple):
+    with _RUN_CACHE_LOCK:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
     return None
 
-def _cache_set(cache: "OrderedDict[Tuple[str, str], Dict[str, Any]]", key: Tuple[str, str], value: Dict[str, Any]):
-    cache[key] = value
-    while len(cache) > RUN_CACHE_SIZE:
-        cache.popitem(last=False)
+def _cache_set(cache: "OrderedDict[Tuple, Any]", key: Tuple, value: Any, size: int = RUN_CACHE_SIZE):
+    with _RUN_CACHE_LOCK:
+        cache[key] = value
+        while len(cache) > size:
+            cache.popitem(last=False)
 
 # Path safety helpers
 _DEF_ERR = "Invalid path"
@@ -89,36 +93,60 @@ def _safe_run_path(collection: str, run_file: str) -> Path:
         raise HTTPException(status_code=400, detail=_DEF_ERR)
     if not run_file.lower().endswith(".json"):
         raise HTTPException(status_code=400, detail="Only .json run files are allowed")
-    base = (COLLECTIONS_DIR / collection).resolve()
+    base = (_COLLECTIONS_ROOT / collection).resolve()
     target = (base / run_file).resolve()
-    try:
-        common = os.path.commonpath([str(base), str(target)])
-    except Exception:
-        raise HTTPException(status_code=400, detail=_DEF_ERR)
-    if common != str(base):
+    if not target.is_relative_to(base):
         raise HTTPException(status_code=400, detail=_DEF_ERR)
     return target
 
 @app.get("/")
-async def root():
+def root():
     return {"message": "RAG-Debugger Backend is running"}
 
+# Last listing with the mtimes it was built from: the root's (collections added/removed) and each
+# collection directory's (run files added/removed). Renaming into or out of a directory bumps its mtime.
+_COLLECTIONS_CACHE: Optional[Tuple[int, Dict[str, int], Dict[str, List[str]]]] = None
+
+def _collections_cache_valid(root_mtime: int) -> bool:
+    if _COLLECTIONS_CACHE is None or _COLLECTIONS_CACHE[0] != root_mtime:
+        return False
+    try:
+        return all(
+            (COLLECTIONS_DIR / name).stat().st_mtime_ns == mtime
+            for name, mtime in _COLLECTIONS_CACHE[1].items()
+        )
+    except OSError:
+        return False
+
 @app.get("/collections")
-async def get_collections():
+def get_collections():
     """Get list of collections and their run files."""
+    global _COLLECTIONS_CACHE
     try:
         logger.info("Listing collections...")
         if not COLLECTIONS_DIR.exists():
             logger.error("Collections directory does not exist")
             raise HTTPException(status_code=404, detail="Collections directory not found")
-        
+
+        # Stat before listing, so a change made during the walk invalidates the stored result
+        root_mtime = COLLECTIONS_DIR.stat().st_mtime_ns
+        if _collections_cache_valid(root_mtime):
+            collections = _COLLECTIONS_CACHE[2]
+            logger.info(f"Found {len(collections)} collections (cached)")
+            return collections
+
+        # scandir entries carry their type from the directory read, so no per-entry Path or stat
         collections = {}
-        for collection_dir in COLLECTIONS_DIR.iterdir():
-            if collection_dir.is_dir():
-                run_files = []
-                for file_path in collection_dir.glob("*.json"):
-                    run_files.append(file_path.name)
-                collections[collection_dir.name] = sorted(run_files)
+        dir_mtimes = {}
+        with os.scandir(COLLECTIONS_DIR) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dir_mtimes[entry.name] = entry.stat().st_mtime_ns
+                    with os.scandir(entry.path) as files:
+                        collections[entry.name] = sorted(
+                            f.name for f in files if f.name.endswith(".json") and f.is_file()
+                        )
+        _COLLECTIONS_CACHE = (root_mtime, dir_mtimes, collections)
         
         logger.info(f"Found {len(collections)} collections")
         return collections
@@ -126,51 +154,216 @@ async def get_collections():
         logger.error(f"Error listing collections: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/collections/{collection}/runs/{run_file}")
-async def get_run(collection: str, run_file: str, derived: bool = False):
-    """Get a specific run JSON file. With derived=true, returns a cached enriched version."""
+def _parse_run_json(run_bytes: bytes) -> Dict[str, Any]:
+    try:
+        return orjson.loads(run_bytes)
+    except orjson.JSONDecodeError:
+        # orjson is strict JSON; stdlib json also accepts NaN/Infinity, which metric files can contain
+        return json.loads(run_bytes)
+
+def _load_run_file(run_path: Path) -> Dict[str, Any]:
+    # Plain read, not mmap: a file truncated or rewritten in place while mapped would kill the server
+    # with SIGBUS, and on Windows an open mapping blocks replacing the file
+    return _parse_run_json(run_path.read_bytes())
+
+# compute_derived_metrics is pure-Python CPU work; worker processes let concurrent derivations
+# use several cores instead of queueing on the GIL
+DERIVE_WORKERS = max(1, int(os.getenv("DERIVE_WORKERS", str(os.cpu_count() or 1))))
+_DERIVE_POOL: Optional[ProcessPoolExecutor] = None
+_DERIVE_POOL_LOCK = threading.Lock()
+
+def _derive_run_file(run_path: Path) -> Dict[str, Any]:
+    # Runs in a worker, which reads and parses its own copy: only the path is pickled
+    return compute_derived_metrics(_load_run_file(run_path))
+
+def _submit_derive(fn, arg) -> "Future[Dict[str, Any]]":
+    global _DERIVE_POOL
+    with _DERIVE_POOL_LOCK:
+        if _DERIVE_POOL is None:
+            _DERIVE_POOL = ProcessPoolExecutor(max_workers=DERIVE_WORKERS)
+        pool = _DERIVE_POOL
+    try:
+        return pool.submit(fn, arg)
+    except BrokenProcessPool:
+        # The pool noticed a dead worker before this submit; replace it once
+        _stop_derive_pool(pool)
+        return _submit_derive(fn, arg)
+
+def _derive_result(future: "Future[Dict[str, Any]]", fn, arg) -> Dict[str, Any]:
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        # A worker died mid-task (e.g. OOM-killed); drop the pool and finish this one in-process
+        logger.warning("Derive worker pool broke; computing in-process")
+        _stop_derive_pool()
+        return fn(arg)
+
+def _stop_derive_pool(expected: Optional[ProcessPoolExecutor] = None) -> None:
+    global _DERIVE_POOL
+    with _DERIVE_POOL_LOCK:
+        pool = _DERIVE_POOL
+        if pool is None or (expected is not None and pool is not expected):
+            return
+        _DERIVE_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+app.add_event_handler("shutdown", _stop_derive_pool)
+
+# Derived runs are also persisted next to their source, in collections/<c>/.derived/, as
+# <run_file>.<mtime_ns>-<size>.json; they survive restarts and are shared between server processes
+DERIVED_DIR_NAME = ".derived"
+
+def _source_sig(run_path: Path) -> str:
+    st = run_path.stat()
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+def _derived_disk_path(run_path: Path, sig: str) -> Path:
+    return run_path.parent / DERIVED_DIR_NAME / f"{run_path.name}.{sig}.json"
+
+def _read_derived_disk(run_path: Path, sig: str) -> Optional[Tuple[Dict[str, Any], bytes]]:
+    """Parsed entry plus its file bytes, which are the encoded response for this run version."""
     try:
-        key = (collection, run_file)
+        payload = _derived_disk_path(run_path, sig).read_bytes()
+        return orjson.loads(payload), payload
+    except FileNotFoundError:
+        return None
+    except (OSError, orjson.JSONDecodeError) as e:
+        # A damaged entry is only a cache miss; it is rewritten after recomputing
+        logger.warning(f"Ignoring unreadable derived cache for {run_path.name}: {e}")
+        return None
+
+def _write_derived_disk(run_path: Path, sig: str, payload: bytes) -> None:
+    target = _derived_disk_path(run_path, sig)
+    tmp = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        target.parent.mkdir(exist_ok=True)
+        tmp.write_bytes(payload)
+        # Atomic rename: concurrent readers see either no entry or a complete one
+        os.replace(tmp, target)
+    except OSError as e:
+        logger.warning(f"Could not persist derived cache for {run_path.name}: {e}")
+        tmp.unlink(missing_ok=True)
+        return
+
+    # Drop entries for earlier versions of this run file. Best-effort: the new entry is already in
+    # place, and on Windows another server process may still hold an old one open
+    stale = re.compile(re.escape(run_path.name) + r"\.\d+-\d+\.json")
+    try:
+        for entry in target.parent.iterdir():
+            if entry != target and stale.fullmatch(entry.name):
+                entry.unlink(missing_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not prune stale derived cache for {run_path.name}: {e}")
+
+def _load_run_entry(collection: str, run_file: str, derived: bool) -> Tuple[Dict[str, Any], Optional[bytes], str]:
+    """Load a run through the LRU and disk caches; backs load_run and load_run_bytes.
+
+    Returns the run, its orjson encoding when this call already has it (a disk hit or a fresh
+    derivation, else None) and the source signature it was loaded under.
+    """
+    try:
+        run_path = _safe_run_path(collection, run_file)
+        try:
+            sig = _source_sig(run_path)
+        except FileNotFoundError:
+            logger.error(f"Run file not found: {run_path}")
+            raise HTTPException(status_code=404, detail="Run file not found")
+
+        key = (collection, run_file, sig)
         if derived:
             cached = _cache_get(_RUN_CACHE_DERIVED, key)
             if cached is not None:
                 logger.info(f"Cache hit (derived): {collection}/{run_file}")
-                return cached
+                return cached, None, sig
+            entry = _read_derived_disk(run_path, sig)
+            if entry is not None:
+                logger.info(f"Disk cache hit (derived): {collection}/{run_file}")
+                _cache_set(_RUN_CACHE_DERIVED, key, entry[0])
+                return entry[0], entry[1], sig
         else:
             cached = _cache_get(_RUN_CACHE_RAW, key)
             if cached is not None:
                 logger.info(f"Cache hit (raw): {collection}/{run_file}")
-                return cached
+                return cached, None, sig
 
         logger.info(f"Loading run: {collection}/{run_file}")
-        run_path = _safe_run_path(collection, run_file)
-        if not run_path.exists():
-            logger.error(f"Run file not found: {run_path}")
-            raise HTTPException(status_code=404, detail="Run file not found")
-
-        with open(run_path, 'r', encoding='utf-8') as f:
-            raw_run = json.load(f)
-        _cache_set(_RUN_CACHE_RAW, key, raw_run)
-
         if derived:
-            # Work on a deep copy to keep raw cache pristine
-            run_copy = json.loads(json.dumps(raw_run))
-            enriched = compute_derived_metrics(run_copy)
-            _cache_set(_RUN_CACHE_DERIVED, key, enriched)
-            logger.info(f"Successfully loaded + derived: {collection}/{run_file}")
-            return enriched
-        else:
+            # The worker parses its own copy (keeps raw cache pristine) while the raw run is loaded here
+            future = _submit_derive(_derive_run_file, run_path)
+        # A derived miss often follows a raw load of the same version; reuse that parse when cached
+        raw_run = _cache_get(_RUN_CACHE_RAW, key) if derived else None
+        if raw_run is None:
+            raw_run = _load_run_file(run_path)
+            _cache_set(_RUN_CACHE_RAW, key, raw_run)
+
+        if not derived:
             logger.info(f"Successfully loaded run: {collection}/{run_file}")
-            return raw_run
-    except json.JSONDecodeError as e:
+            return raw_run, None, sig
+
+        enriched = _derive_result(future, _derive_run_file, run_path)
+        _cache_set(_RUN_CACHE_DERIVED, key, enriched)
+        try:
+            # Encoded once: the same bytes are persisted and returned for the HTTP response
+            payload = orjson.dumps(enriched)
+        except TypeError as e:
+            logger.warning(f"Could not persist derived cache for {run_path.name}: {e}")
+            payload = None
+        else:
+            _write_derived_disk(run_path, sig, payload)
+        logger.info(f"Successfully loaded + derived: {collection}/{run_file}")
+        return enriched, payload, sig
+    except (json.JSONDecodeError, orjson.JSONDecodeError) as e:
         logger.error(f"Invalid JSON in run file {collection}/{run_file}: {str(e)}")
         raise HTTPException(status_code=400, detail="Invalid JSON file")
     except Exception as e:
         logger.error(f"Error loading run {collection}/{run_file}: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-def analyze_entailment_relations(relations_matrix: List[List[str]], chunk_count: int) -> Dict[str, int]:
-    """Analyze entailment relations for chunks.
+def load_run(collection: str, run_file: str, derived: bool = False) -> Dict[str, Any]:
+    """Load a run (raw or derived) through the LRU caches. Shared by the HTTP route and the agent."""
+    return _load_run_entry(collection, run_file, derived)[0]
+
+def load_run_bytes(collection: str, run_file: str, derived: bool = False) -> bytes:
+    """load_run, JSON-encoded once per run version; repeated requests skip serialization entirely."""
+    run_path = _safe_run_path(collection, run_file)
+    try:
+        key = (collection, run_file, _source_sig(run_path), derived)
+    except OSError:
+        key = None  # _load_run_entry reports missing or unreadable files
+    if key is not None:
+        cached = _cache_get(_RUN_CACHE_BYTES, key)
+        if cached is not None:
+            return cached
+
+    run, payload, sig = _load_run_entry(collection, run_file, derived)
+    if payload is None:
+        try:
+            payload = orjson.dumps(run)
+        except TypeError:
+            # orjson rejects e.g. integers beyond 64 bits (kept by the stdlib NaN fallback parse);
+            # stdlib json handles them
+            payload = json.dumps(run, ensure_ascii=False).encode("utf-8")
+    # Keyed by the signature the run was loaded under, in case the file changed since the lookup
+    _cache_set(_RUN_CACHE_BYTES, (collection, run_file, sig, derived), payload, size=2 * RUN_CACHE_SIZE)
+    return payload
+
+@app.get("/collections/{collection}/runs/{run_file}")
+def get_run(collection: str, run_file: str, derived: bool = False):
+    """Get a specific run JSON file. With derived=true, returns a cached enriched version."""
+    # Pre-encoded body: no jsonable_encoder walk and, on a cache hit, no serialization at all
+    return Response(content=load_run_bytes(collection, run_file, derived), media_type="application/json")
+
+# Include agent routes (after load_run so the agent can read runs in-process)
+try:
+    from agent.routes import router as agent_router, register_run_loader
+    register_run_loader(load_run)
+    app.include_router(agent_router, prefix="/agent")
+    logger.info("Agent routes mounted at /agent")
+except Exception as e:
+    logger.warning(f"Agent routes not mounted: {e}")
+
+def _relation_counts(relations_matrix: List[List[str]], chunk_count: int) -> List[Tuple[int, int, int, int]]:
+    """Count entailment relations per chunk as (entailments, neutrals, contradictions, total) tuples.
 
     Handles both orientations:
     - chunks-first: rows = chunks, cols = claims
@@ -178,8 +371,6 @@ def analyze_entailment_relations(relations_matrix: List[List[str]], chunk_count:
 
     We infer orientation by comparing outer length and first-row length to chunk_count.
     """
-    chunk_relations: Dict[int, Dict[str, int]] = {}
-
     try:
         rows = len(relations_matrix) if isinstance(relations_matrix, list) else 0
         cols = 0
@@ -207,103 +398,51 @@ def analyze_entailment_relations(relations_matrix: List[List[str]], chunk_count:
                 orientation = 'rows_are_chunks'
                 claim_count = cols
 
-        def safe_get(r: int, c: int) -> str:
-            try:
-                row = relations_matrix[r] if r < len(relations_matrix) and isinstance(relations_matrix[r], list) else None
-                if row is None:
-                    return ''
-                return row[c] if c < len(row) else ''
-            except Exception:
-                return ''
-
+        # Collect each chunk's cells as one list (a matrix row, or a column gathered by zip_longest)
+        # so the label counts below run as C-level list scans instead of per-cell Python code
+        if orientation == 'rows_are_chunks':
+            chunk_cells = [
+                row if isinstance(row, list) else []
+                for row in islice(relations_matrix, chunk_count)
+            ]
+        else:  # rows_are_claims
+            claim_rows = [row if isinstance(row, list) else [] for row in relations_matrix[:max(0, claim_count)]]
+            chunk_cells = [list(col) for col in islice(zip_longest(*claim_rows, fillvalue=''), chunk_count)]
+
+        counts = []
         for chunk_idx in range(chunk_count):
-            entailments = neutrals = contradictions = total = 0
-
-            if orientation == 'rows_are_chunks':
-                # Iterate claims along columns
-                for claim_idx in range(max(0, claim_count)):
-                    rel = safe_get(chunk_idx, claim_idx)
-                    if not rel:
-                        continue
-                    total += 1
-                    if rel == "Entailment":
-                        entailments += 1
-                    elif rel == "Neutral":
-                        neutrals += 1
-                    elif rel == "Contradiction":
-                        contradictions += 1
-            else:  # rows_are_claims
-                for claim_idx in range(max(0, claim_count)):
-                    rel = safe_get(claim_idx, chunk_idx)
-                    if not rel:
-                        continue
-                    total += 1
-                    if rel == "Entailment":
-                        entailments += 1
-                    elif rel == "Neutral":
-                        neutrals += 1
-                    elif rel == "Contradiction":
-                        contradictions += 1
-
-            chunk_relations[chunk_idx] = {
-                "entailments": entailments,
-                "neutrals": neutrals,
-                "contradictions": contradictions,
-                "total": total
-            }
-
-        return chunk_relations
+            cells = chunk_cells[chunk_idx] if chunk_idx < len(chunk_cells) else []
+            entailments = cells.count("Entailment")
+            neutrals = cells.count("Neutral")
+            contradictions = cells.count("Contradiction")
+            total = entailments + neutrals + contradictions
+            if total != len(cells):
+                # Only rows with padding or unknown labels need the scan; empty cells are not relations
+                total = sum(map(bool, cells))
+            counts.append((entailments, neutrals, contradictions, total))
+
+        return counts
     except Exception:
-        # Fallback: return zeros with expected keys
-        for chunk_idx in range(chunk_count):
-            chunk_relations[chunk_idx] = {
-                "entailments": 0,
-                "neutrals": 0,
-                "contradictions": 0,
-                "total": 0
-            }
-        return chunk_relations
-
-def calculate_chunk_frequency_stats(questions: List[Dict]) -> Dict[str, Any]:
-    """Calculate chunk frequency statistics. Reusable across different analysis types."""
-    chunk_stats = {}
-    
-    for question in questions:
-        if "retrieved_context" not in question:
-            continue
-            
-        query_id = question.get("query_id", "unknown")
-        retrieved_context = question.get("retrieved_context", [])
-        
-        for chunk in retrieved_context:
-            chunk_key = f"{chunk['doc_id']}::{chunk['text']}"
-            
-            if chunk_key not in chunk_stats:
-                chunk_stats[chunk_key] = {
-                    "doc_id": chunk["doc_id"],
-                    "text": chunk["text"],
-                    "total_appearances": 0,
-                    "questions_appeared": []
-                }
-            
-            stats = chunk_stats[chunk_key]
-            stats["total_appearances"] += 1
-            
-            if query_id not in stats["questions_appeared"]:
-                stats["questions_appeared"].append(query_id)
-    
-    # Add frequency rankings
+        # Fallback: zeros for every chunk
+        return [(0, 0, 0, 0)] * chunk_count
+
+# Chunks are identified by (doc_id, text). The tuple reuses the chunk's own string objects, whose
+# hashes are cached, so lookups neither copy nor rehash long chunk texts.
+ChunkKey = Tuple[Any, Any]
+
+def _rank_chunk_stats(chunk_stats: Dict[ChunkKey, Dict[str, Any]]) -> Dict[ChunkKey, Any]:
+    # Add frequency rankings (keys travel with the stats, so they are not rebuilt from the text)
     chunks_by_frequency = sorted(
-        chunk_stats.values(),
-        key=lambda x: x["total_appearances"],
+        chunk_stats.items(),
+        key=lambda item: item[1]["total_appearances"],
         reverse=True
     )
     
     ranked_stats = {}
-    for rank, chunk_info in enumerate(chunks_by_frequency, 1):
-        chunk_key = f"{chunk_info['doc_id']}::{chunk_info['text']}"
+    for rank, (chunk_key, chunk_info) in enumerate(chunks_by_frequency, 1):
         ranked_stats[chunk_key] = {
             **chunk_info,
+            "questions_appeared": list(chunk_info["questions_appeared"]),
             "frequency_rank": rank,
             "total_unique_chunks": len(chunks_by_frequency)
         }
@@ -320,40 +459,38 @@ def calculate_importance_metrics(frequency: int, gt_entailments: int, total_gt_r
         "response_entailment_rate": round(response_entailment_rate, 3)
     }
 
+def _relation_cells(row: Any) -> List[Any]:
+    # list.count compares whole elements; any other iterable row is listed first so a string
+    # row is scanned per character, as plain iteration would
+    return row if isinstance(row, list) else list(row)
+
 def analyze_local_chunk_relations(question: Dict[str, Any]) -> Dict[int, Dict[str, Any]]:
     """Analyze entailment relations for chunks within the current question only."""
     retrieved_context = question.get("retrieved_context", [])
     retrieved2answer = question.get("retrieved2answer", [])
     retrieved2response = question.get("retrieved2response", [])
     
-    logger.info(f"Analyzing local relations: {len(retrieved_context)} chunks, {len(retrieved2answer)} GT relations, {len(retrieved2response)} response relations")
+    logger.debug("Analyzing local relations: %d chunks, %d GT relations, %d response relations", len(retrieved_context), len(retrieved2answer), len(retrieved2response))
     
     local_relations = {}
     
     for chunk_idx in range(len(retrieved_context)):
-        # Initialize counters
         gt_entailments = gt_neutrals = gt_contradictions = 0
         response_entailments = response_neutrals = response_contradictions = 0
-        
+
         # Analyze GT relations for this chunk
         if chunk_idx < len(retrieved2answer):
-            for relation in retrieved2answer[chunk_idx]:
-                if relation == "Entailment":
-                    gt_entailments += 1
-                elif relation == "Neutral":
-                    gt_neutrals += 1
-                elif relation == "Contradiction":
-                    gt_contradictions += 1
-        
+            cells = _relation_cells(retrieved2answer[chunk_idx])
+            gt_entailments = cells.count("Entailment")
+            gt_neutrals = cells.count("Neutral")
+            gt_contradictions = cells.count("Contradiction")
+
         # Analyze response relations for this chunk
         if chunk_idx < len(retrieved2response):
-            for relation in retrieved2response[chunk_idx]:
-                if relation == "Entailment":
-                    response_entailments += 1
-                elif relation == "Neutral":
-                    response_neutrals += 1
-                elif relation == "Contradiction":
-                    response_contradictions += 1
+            cells = _relation_cells(retrieved2response[chunk_idx])
+            response_entailments = cells.count("Entailment")
+            response_neutrals = cells.count("Neutral")
+            response_contradictions = cells.count("Contradiction")
         
         result = {
             "local_gt_entailments": gt_entailments,
@@ -367,64 +504,22 @@ def analyze_local_chunk_relations(question: Dict[str, Any]) -> Dict[int, Dict[st
         }
         
         local_relations[chunk_idx] = result
-        logger.info(f"Chunk {chunk_idx}: GT={gt_entailments}E/{gt_neutrals}N/{gt_contradictions}C, Resp={response_entailments}E/{response_neutrals}N/{response_contradictions}C")
+        logger.debug("Chunk %d: GT=%dE/%dN/%dC, Resp=%dE/%dN/%dC", chunk_idx, gt_entailments, gt_neutrals, gt_contradictions, response_entailments, response_neutrals, response_contradictions)
     
     return local_relations
 
-def build_chunk_effectiveness_lookup(questions: List[Dict]) -> Dict[str, Any]:
-    """Build comprehensive chunk effectiveness lookup. Orchestrates all analysis functions."""
-    # Get frequency statistics
-    frequency_stats = calculate_chunk_frequency_stats(questions)
+# Accumulated entailment counts per chunk are kept as flat int lists in this order (GT relations, then
+# response relations, as _relation_counts yields them) and become dicts only in the final lookup
+_ENTAILMENT_FIELDS = (
+    "gt_entailments", "gt_neutrals", "gt_contradictions", "total_gt_relations",
+    "response_entailments", "response_neutrals", "response_contradictions", "total_response_relations"
+)
+
+def _build_chunk_lookup(frequency_stats: Dict[ChunkKey, Any], chunk_entailment_data: Dict[ChunkKey, List[int]]) -> Dict[ChunkKey, Any]:
+    """Combine ranked frequency stats with the accumulated entailment counts per chunk."""
     chunk_lookup = {}
-    
-    # Analyze each question for entailment data
-    chunk_entailment_data = {}
-    for question in questions:
-        if "retrieved_context" not in question:
-            continue
-            
-        retrieved_context = question.get("retrieved_context", [])
-        retrieved2answer = question.get("retrieved2answer", [])
-        retrieved2response = question.get("retrieved2response", [])
-        
-        # Analyze entailments for this question
-        gt_relations = analyze_entailment_relations(retrieved2answer, len(retrieved_context))
-        response_relations = analyze_entailment_relations(retrieved2response, len(retrieved_context))
-        
-        # Accumulate data for each chunk
-        for chunk_idx, chunk in enumerate(retrieved_context):
-            chunk_key = f"{chunk['doc_id']}::{chunk['text']}"
-            
-            if chunk_key not in chunk_entailment_data:
-                chunk_entailment_data[chunk_key] = {
-                    "gt_entailments": 0, "gt_neutrals": 0, "gt_contradictions": 0, "total_gt_relations": 0,
-                    "response_entailments": 0, "response_neutrals": 0, "response_contradictions": 0, "total_response_relations": 0
-                }
-            
-            data = chunk_entailment_data[chunk_key]
-            
-            # Add GT relations
-            if chunk_idx in gt_relations:
-                gt_rel = gt_relations[chunk_idx]
-                data["gt_entailments"] += gt_rel["entailments"]
-                data["gt_neutrals"] += gt_rel["neutrals"]
-                data["gt_contradictions"] += gt_rel["contradictions"]
-                data["total_gt_relations"] += gt_rel["total"]
-            
-            # Add response relations
-            if chunk_idx in response_relations:
-                resp_rel = response_relations[chunk_idx]
-                data["response_entailments"] += resp_rel["entailments"]
-                data["response_neutrals"] += resp_rel["neutrals"]
-                data["response_contradictions"] += resp_rel["contradictions"]
-                data["total_response_relations"] += resp_rel["total"]
-    
-    # Build final lookup combining frequency and entailment data
     for chunk_key, freq_data in frequency_stats.items():
-        entailment_data = chunk_entailment_data.get(chunk_key, {
-            "gt_entailments": 0, "gt_neutrals": 0, "gt_contradictions": 0, "total_gt_relations": 0,
-            "response_entailments": 0, "response_neutrals": 0, "response_contradictions": 0, "total_response_relations": 0
-        })
+        entailment_data = dict(zip(_ENTAILMENT_FIELDS, chunk_entailment_data.get(chunk_key) or [0] * 8))
         
         # Calculate importance metrics
         importance = calculate_importance_metrics(
@@ -445,7 +540,11 @@ def build_chunk_effectiveness_lookup(questions: List[Dict]) -> Dict[str, Any]:
     return chunk_lookup
 
 def compute_derived_metrics(run_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Compute and attach derived metrics to the run_data (in-place) and return it."""
+    """Compute and attach derived metrics to the run_data (in-place) and return it.
+
+    One pass over the questions gathers the per-question metrics, the chunk frequency stats and the
+    entailment counts; effectiveness analyses are attached once the global lookup is complete.
+    """
     logger.info("Computing derived metrics...")
 
     # Handle both direct results and nested results structure
@@ -453,55 +552,109 @@ def compute_derived_metrics(run_data: Dict[str, Any]) -> Dict[str, Any]:
     if isinstance(questions, dict) and "results" in questions:
         questions = questions["results"]
 
-    # Calculate chunk effectiveness analysis using modular functions
-    chunk_effectiveness_lookup = build_chunk_effectiveness_lookup(questions)
+    chunk_stats: Dict[ChunkKey, Dict[str, Any]] = {}
+    chunk_entailment_data: Dict[ChunkKey, List[int]] = {}
+    # (chunk, key, local analysis) for every retrieved chunk, attached after the pass
+    pending: List[Tuple[Dict[str, Any], ChunkKey, Dict[str, Any]]] = []
 
-    # Add derived metrics for each question
     for question in questions:
-        if "retrieved_context" in question:
-            # Calculate context length in words
-            context_text = " ".join([chunk["text"] for chunk in question["retrieved_context"]])
-            question["context_length"] = len(context_text.split())
-            question["num_chunks"] = len(question["retrieved_context"])
-
-            # Get local entailment analysis for this question
-            local_relations = analyze_local_chunk_relations(question)
-            logger.info(f"Question {question.get('query_id')}: Created local analysis for {len(local_relations)} chunks")
-
-            # Add effectiveness analysis to each chunk
-            for chunk_idx, chunk in enumerate(question["retrieved_context"]):
-                chunk_key = f"{chunk['doc_id']}::{chunk['text']}"
-
-                # Add global effectiveness analysis
-                if chunk_key in chunk_effectiveness_lookup:
-                    chunk["effectiveness_analysis"] = chunk_effectiveness_lookup[chunk_key]
-
-                # Add local analysis for this question - FORCE IT
-                if chunk_idx in local_relations:
-                    chunk["local_analysis"] = local_relations[chunk_idx]
-                    logger.info(f"Chunk {chunk_idx}: Added local analysis {chunk['local_analysis']}")
-                else:
-                    chunk["local_analysis"] = {
-                        "local_gt_entailments": 0,
-                        "local_gt_neutrals": 0,
-                        "local_gt_contradictions": 0,
-                        "local_gt_total": 0,
-                        "local_response_entailments": 0,
-                        "local_response_neutrals": 0,
-                        "local_response_contradictions": 0,
-                        "local_response_total": 0
-                    }
-                    logger.warning(f"Chunk {chunk_idx}: NO local relations found, using zeros")
+        if "retrieved_context" not in question:
+            continue
+
+        query_id = question.get("query_id", "unknown")
+        retrieved_context = question["retrieved_context"]
+        chunk_count = len(retrieved_context)
+
+        # Calculate context length in words (per chunk: the joined context string is never needed)
+        question["context_length"] = sum(len(chunk["text"].split()) for chunk in retrieved_context)
+        question["num_chunks"] = chunk_count
+
+        # Global (accumulated across questions) and local entailment analysis for this question
+        gt_counts = _relation_counts(question.get("retrieved2answer", []), chunk_count)
+        response_counts = _relation_counts(question.get("retrieved2response", []), chunk_count)
+        local_relations = analyze_local_chunk_relations(question)
+        logger.debug("Question %s: Created local analysis for %d chunks", query_id, len(local_relations))
+
+        for chunk_idx, chunk in enumerate(retrieved_context):
+            chunk_key = (chunk["doc_id"], chunk["text"])
+
+            stats = chunk_stats.get(chunk_key)
+            if stats is None:
+                stats = chunk_stats[chunk_key] = {
+                    "doc_id": chunk["doc_id"],
+                    "text": chunk["text"],
+                    "total_appearances": 0,
+                    # Insertion-ordered set: O(1) membership, listed in first-appearance order when ranked
+                    "questions_appeared": {}
+                }
+                data = chunk_entailment_data[chunk_key] = [0] * 8
+            else:
+                data = chunk_entailment_data[chunk_key]
+            stats["total_appearances"] += 1
+            stats["questions_appeared"][query_id] = None
+
+            gt_e, gt_n, gt_c, gt_t = gt_counts[chunk_idx]
+            resp_e, resp_n, resp_c, resp_t = response_counts[chunk_idx]
+            data[0] += gt_e
+            data[1] += gt_n
+            data[2] += gt_c
+            data[3] += gt_t
+            data[4] += resp_e
+            data[5] += resp_n
+            data[6] += resp_c
+            data[7] += resp_t
+
+            # Local analysis for this question - FORCE IT
+            local = local_relations.get(chunk_idx)
+            if local is None:
+                local = {
+                    "local_gt_entailments": 0,
+                    "local_gt_neutrals": 0,
+                    "local_gt_contradictions": 0,
+                    "local_gt_total": 0,
+                    "local_response_entailments": 0,
+                    "local_response_neutrals": 0,
+                    "local_response_contradictions": 0,
+                    "local_response_total": 0
+                }
+                logger.warning("Chunk %d: NO local relations found, using zeros", chunk_idx)
+            pending.append((chunk, chunk_key, local))
+
+    chunk_effectiveness_lookup = _build_chunk_lookup(_rank_chunk_stats(chunk_stats), chunk_entailment_data)
+
+    # Add effectiveness and local analysis to each chunk
+    for chunk, chunk_key, local in pending:
+        if chunk_key in chunk_effectiveness_lookup:
+            chunk["effectiveness_analysis"] = chunk_effectiveness_lookup[chunk_key]
+        chunk["local_analysis"] = local
 
     logger.info("Successfully computed derived metrics with chunk effectiveness analysis")
     return run_data
 
+# /derive responses by a digest of the posted run: posting an unchanged run again skips derivation
+_DERIVE_CACHE: "OrderedDict[Tuple[bytes], bytes]" = OrderedDict()
+
 @app.post("/derive")
-async def derive_metrics(run_data: Dict[str, Any]):
+def derive_metrics(run_data: Dict[str, Any]):
     """Add derived metrics to run data."""
     try:
-        result = compute_derived_metrics(run_data)
-        return result
+        key = None
+        try:
+            key = (hashlib.blake2b(orjson.dumps(run_data), digest_size=16).digest(),)
+        except TypeError:
+            pass  # not orjson-encodable (e.g. integers beyond 64 bits); derive without caching
+        if key is not None:
+            cached = _cache_get(_DERIVE_CACHE, key)
+            if cached is not None:
+                return Response(content=cached, media_type="application/json")
+
+        future = _submit_derive(compute_derived_metrics, run_data)
+        result = _derive_result(future, compute_derived_metrics, run_data)
+        if key is None:
+            return JSONResponse(content=result)
+        payload = orjson.dumps(result)
+        _cache_set(_DERIVE_CACHE, key, payload)
+        return Response(content=payload, media_type="application/json")
     except Exception as e:
         logger.error(f"Error computing derived metrics: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,72 @@
+import pytest
+
+from agent.routes import _build_code
+
+
+ACCEPTED = [
+    "len(data)",
+    "1+1",
+    "[q['query_id'] for q in questions][:5]",
+    "{'n': len(questions)}",
+    "sorted(questions, key=lambda q: q.get('metrics', {}).get('f1', 0))[:3]",
+    "max((v for v in columns['f1'] if v is not None), default=None)",
+    "[columns['query_ids'][i] for i, v in enumerate(columns['f1']) if v is not None and v < 0.5]",
+    "sum(columns['num_chunks']) * 100 / max(len(questions), 1)",
+    "', '.join(q['query_id'] for q in questions)",
+    "[0] * 10",
+    "'-' * 80",
+    "x == 1",
+    "q['query'] == 'k=v'",
+    "[q for q in questions if q.get('query', '').find('a=b') >= 0]",
+    "q['precision'] * q['recall'] * 2",
+    "'%.3f' % 0.5",
+    "f'{0.5:.3f} / {x!r:>12}'",
+    "len(questions) % 2",
+    "[i for i in range(len(questions))]",
+    "list(range(10))",
+    "q['text'].replace('\\n', ' ').replace('  ', ' ')",
+    "q['text'].replace('&', 'and')",
+]
+
+REJECTED = [
+    "[0]*10**9",
+    "[0]*1000000000",
+    "[0]*1000*1000",
+    "'a'*(1<<30)",
+    "2**64",
+    "-10**9",
+    "'%1000000000s' % ''",
+    "'%*s' % (1000000000, '')",
+    "f'{1:>1000000000}'",
+    "f'{1:>{w}}'",
+    "'a'*int('1000000000')",
+    "[0]*int(1e9)",
+    "'a'*len(questions)",
+    "[0]*(5000+5000)*(5000+5000)",
+    "list(range(100000000))",
+    "list(range(0, 100000000, 1))",
+    "'a'.replace('a', 'a'*10000).replace('a', 'a'*10000)",
+    "'a'.replace('a', 'aaaa').replace('a', 'aaaa')",
+    "().__class__",
+    "().__class__.__bases__[0].__subclasses__()",
+    "'{}'.format(data)",
+    "__import__('os')",
+    "open('main.py')",
+    "getattr(data, 'keys')",
+    "(lambda: 1)()",
+    "[y := 1]",
+    "q = 1",
+    "1; 2",
+    "1\n2",
+]
+
+
+@pytest.mark.parametrize("expr", ACCEPTED)
+def test_accepts_read_only_queries(expr):
+    _build_code(expr)
+
+
+@pytest.mark.parametrize("expr", REJECTED)
+def test_rejects_escapes_and_amplifiers(expr):
+    with pytest.raises(ValueError):
+        _build_code(expr)